@@ -3,10 +3,160 @@ Author: Tom Holoien
 License: MIT
 """
 
+import copy
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+import pandas as pd
+from scipy.linalg import solve_triangular
+from joblib import Parallel, delayed
 
 from xdgmm import XDGMM
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _sersic_sb_numpy(sersic_idx, halfmag, magerr, Re, Re_err, sep):
+    """
+    Computes local surface brightnesses and their uncertainties for
+    an exponential (sersic_idx = 1) or de Vaucouleurs (sersic_idx = 4)
+    profile. See Empiricist.get_local_SB.
+
+    Evaluates all filters at once; used when numba is not available.
+    """
+    r = sep/Re
+
+    Ie = halfmag + 0.75257 + 2.5 * np.log10(np.pi*Re**2)
+    Re2_unc = 2 * Re * Re_err * np.pi
+    log_unc = 2.5 * Re2_unc/(np.log10(np.pi*Re**2) * np.log(10))
+    Io_unc = np.sqrt(magerr**2 + log_unc**2)
+
+    if sersic_idx == 1:
+        Io = Ie-1.824
+        exp_term = np.exp(-1.68*(r))
+        SBs = Io*exp_term
+        exp_unc = exp_term*1.68*sep*Re_err/(Re**2)
+        SB_errs = SBs * np.sqrt((Io_unc/Io)**2 + (exp_unc/exp_term)**2)
+    else:
+        Io = Ie-8.328
+        exp_term = np.exp(-7.67*((r)**0.25))
+        SBs = Io*exp_term
+        exp_unc = exp_term*7.67*sep*Re_err/(4*Re**(1.25))
+        SB_errs = SBs*np.sqrt((Io_unc/Io)**2+(exp_unc/exp_term))
+
+    SB_errs = np.where(np.isnan(SB_errs), 0.0, np.abs(SB_errs))
+    return SBs, SB_errs
+
+
+def _sersic_sb_loop(sersic_idx, halfmag, magerr, Re, Re_err, sep):
+    """
+    Same as _sersic_sb_numpy, written as a loop over filters for numba
+    to compile without creating any temporary arrays.
+    """
+    n_filters = halfmag.shape[0]
+    SBs = np.empty(n_filters)
+    SB_errs = np.empty(n_filters)
+
+    for j in range(n_filters):
+        r = sep/Re[j]
+
+        Ie = halfmag[j] + 0.75257 + 2.5 * np.log10(np.pi*Re[j]**2)
+        Re2_unc = 2 * Re[j] * Re_err[j] * np.pi
+        log_unc = 2.5 * Re2_unc/(np.log10(np.pi*Re[j]**2) * np.log(10))
+        Io_unc = np.sqrt(magerr[j]**2 + log_unc**2)
+
+        if sersic_idx == 1:
+            Io = Ie-1.824
+            exp_term = np.exp(-1.68*(r))
+            sb = Io*exp_term
+            exp_unc = exp_term*1.68*sep*Re_err[j]/(Re[j]**2)
+            sb_unc = sb * np.sqrt((Io_unc/Io)**2 + (exp_unc/exp_term)**2)
+        else:
+            Io = Ie-8.328
+            exp_term = np.exp(-7.67*((r)**0.25))
+            sb = Io*exp_term
+            exp_unc = exp_term*7.67*sep*Re_err[j]/(4*Re[j]**(1.25))
+            sb_unc = sb*np.sqrt((Io_unc/Io)**2+(exp_unc/exp_term))
+
+        if np.isnan(sb_unc): sb_unc = 0.0
+        SBs[j] = sb
+        SB_errs[j] = abs(sb_unc)
+
+    return SBs, SB_errs
+
+
+# error_model='numpy' keeps NumPy's division semantics (inf/NaN instead
+# of ZeroDivisionError) for zero radii or underflowing profiles.
+if njit is not None:
+    _sersic_sb = njit(cache=True, error_model='numpy')(_sersic_sb_loop)
+else:
+    _sersic_sb = _sersic_sb_numpy
+
+
+def _expand_diag(Xerr_diag):
+    """
+    Expands an array of variances, shape = (n_samples, n_features),
+    into diagonal error matrices, shape = (n_samples, n_features,
+    n_features), as expected by XDGMM.fit.
+    """
+    Xerr = np.zeros(Xerr_diag.shape + Xerr_diag.shape[-1:])
+    diag = np.arange(Xerr_diag.shape[-1])
+    Xerr[:, diag, diag] = Xerr_diag
+    return Xerr
+
+
+# Columns read from each data file, in the order they are unpacked in
+# Empiricist.get_data; the last entry is only used to reject rows.
+_DATA_COLS = (7, 8, 9, 10, 11, 12, 4, 15, 42, 43, 18, 19, 20, 21, 22, 23,
+              24, 25, 26, 27, 32, 33, 38, 39, 44, 45, 50, 52, 56, 57, 51)
+# Positions within _DATA_COLS of the local SB errors (columns 33, 39,
+# 45, 51 and 57); rows where any of these is NaN are skipped.
+_SB_ERR_COLS = [21, 23, 25, 30, 29]
+# Maps ugriz magnitudes onto the colors used in the model: ug, ur, ui,
+# uz, gr, gi, gz, ri, rz, iz.
+_COLOR_MATRIX = np.array([[1, -1, 0, 0, 0],
+                          [1, 0, -1, 0, 0],
+                          [1, 0, 0, -1, 0],
+                          [1, 0, 0, 0, -1],
+                          [0, 1, -1, 0, 0],
+                          [0, 1, 0, -1, 0],
+                          [0, 1, 0, 0, -1],
+                          [0, 0, 1, -1, 0],
+                          [0, 0, 1, 0, -1],
+                          [0, 0, 0, 1, -1]], dtype=float)
+
+
+def _read_one_file(filename):
+    """
+    Reads the columns in _DATA_COLS from a data file, dropping rows
+    without local SB errors. Files without data rows give an empty
+    array.
+    """
+    try:
+        df = pd.read_csv(filename, comment='#', header=None,
+                         usecols=_DATA_COLS, dtype=np.float64, engine='c')
+    except pd.errors.EmptyDataError:
+        return np.empty((0, len(_DATA_COLS)))
+    arr = df[list(_DATA_COLS)].values
+    mask = ~np.isnan(arr[:, _SB_ERR_COLS]).any(axis=1)
+    return arr[mask]
+
+
+def _fit_and_bic(model, n_components, X, Xerr, no_err):
+    """
+    Fits a copy of an XDGMM model with n_components components and
+    returns its BIC. Used by Empiricist.component_test.
+    """
+    model = copy.deepcopy(model)
+    model.n_components = n_components
+    model = model.fit(X, Xerr)
+    if no_err: return model.bic(X)
+    return model.bic(X, Xerr)
+
+
 class Empiricist(object):
     """
     Worker object that can fit supernova and host galaxy parameters 
@@ -20,16 +170,29 @@ class Empiricist(object):
     fit_method: string (optional)
         Name of XD fitting method to use (default='astroML'). Must be
         either 'astroML' or 'Bovy'.
+    random_state: int or np.random.Generator (optional)
+        Seed or generator used when sampling SNe and radii
+        (default=None).
 
     Notes
     -----
     The class can be initialized with a model or one can be loaded or
         fit to data.
+
+    get_SN and get_logR sample with the worker's own random generator,
+        so seeding np.random globally does not affect them; pass
+        random_state instead.
     """
-    def __init__(self, model_file=None, fit_method='astroML'):
+    __slots__ = ('XDGMM', 'fit_method', 'model_file', '_rng', '_cond_cache')
+
+    def __init__(self, model_file=None, fit_method='astroML',
+                 random_state=None):
 
         self.XDGMM = XDGMM(n_components=7, method=fit_method)
         self.fit_method = fit_method
+        self.model_file = None
+        self._rng = np.random.default_rng(random_state)
+        self._cond_cache = {}
 
         if model_file is not None:
             self.read_model(model_file)
@@ -41,9 +204,10 @@ class Empiricist(object):
 
         Parameters
         ----------
-        X: array_like, shape = (n_samples, n_features)
+        X: array_like, shape = (n_features,) or (n_hosts, n_features)
             Input data. First 3 entries (SN parameters) should be NaN.
-        Xerr: array_like, shape = (n_samples, n_features), optional
+            If 2D, each row is a separate host galaxy.
+        Xerr: array_like, shape = X.shape, optional
             Error on input data. SN errors should be 0.0. If None,
             errors are not used for the conditioning.
         n_SN: int (optional)
@@ -51,21 +215,27 @@ class Empiricist(object):
 
         Returns
         -------
-        SN_data: array_like, shape = (n_SN, 3)
-            Sample of SN data taken from the conditioned model.
+        SN_data: array_like, shape = (n_SN, 3) or (n_hosts, n_SN, 3)
+            Sample of SN data taken from the conditioned model. If X
+            is 2D, n_SN SNe are sampled for each host.
 
         Notes
         -----
         Assumes that the first three parameters used when fitting
             the model are the SN parameters.
+
+        When X is 2D, all hosts are conditioned and sampled together,
+            so every row must have the same parameters set to NaN.
+            Without Xerr this needs no loop over the rows; with Xerr the
+            covariances of each host are factored in turn.
         """
         if self.model_file is None:
-            raise StandardError("Model parameters not set.")
+            raise RuntimeError("Model parameters not set.")
 
-        if Xerr is None: cond_XDGMM = self.XDGMM.condition(X)
-        else: cond_XDGMM = self.XDGMM.condition(X, Xerr)
-
-        return np.atleast_2d(cond_XDGMM.sample(n_SN))
+        weights, means, chols = self._condition(X, Xerr)
+        SN_data = self._sample_conditioned(weights, means, chols, n_SN)
+        if np.ndim(X) == 2: return SN_data
+        return SN_data[0]
 
     def fit_model(self, X, Xerr, filename='empiriciSN_model.fit',
                   n_components=6):
@@ -77,7 +247,8 @@ class Empiricist(object):
         X: array_like, shape = (n_samples, n_features)
             Input data.
         Xerr: array_like, shape = (n_samples, n_features, n_features)
-            Error on input data.
+            Error on input data. Diagonal errors may also be given as
+            variances with shape (n_samples, n_features).
         filename: string (optional)
             Filename for model fit to be saved to (default =
             'empiriciSN_model.fit').
@@ -93,10 +264,13 @@ class Empiricist(object):
         The fit will be saved in the file with name defined by the 
         filename variable.
         """
+        if np.ndim(Xerr) == 2: Xerr = _expand_diag(Xerr)
         self.XDGMM.n_components = n_components
         self.XDGMM = self.XDGMM.fit(X, Xerr)
         self.XDGMM.save_model(filename)
         self.model_file = filename
+        self._cond_cache = {}
+        self._precompute_sn_conditioning()
         return
 
     def fit_from_files(self, filelist, filename='empiriciSN_model.fit',
@@ -145,9 +319,12 @@ class Empiricist(object):
         """
         self.XDGMM.read_model(filename)
         self.model_file = filename
+        self._cond_cache = {}
+        self._precompute_sn_conditioning()
         return
 
-    def component_test(self, X, Xerr, component_range, no_err=False):
+    def component_test(self, X, Xerr, component_range, no_err=False,
+                       n_jobs=-1):
         """
         Test the performance of the model for a range of numbers of
         Gaussian components.
@@ -157,12 +334,16 @@ class Empiricist(object):
         X: array_like, shape = (n_samples, n_features)
             Input data.
         Xerr: array_like, shape = (n_samples, n_features, n_features)
-            Error on input data.
+            Error on input data. Diagonal errors may also be given as
+            variances with shape (n_samples, n_features).
         component_range: array_like
             Range of n_components to test.
         no_err: bool (optional)
             Flag for whether to calculate the BIC with the errors
             included or not. (default = False)
+        n_jobs: int (optional)
+            Number of processes to fit the models in (default = -1,
+            meaning one per CPU).
 
         Returns
         -------
@@ -175,11 +356,19 @@ class Empiricist(object):
 
         Notes
         -----
-        Uses the XDGMM.bic_test method to compute the BIC score for
-        each n_components in the component_range array.
+        Fits a copy of the model for each n_components in the
+        component_range array and computes its BIC score, as
+        XDGMM.bic_test does. The fits are independent, so they are run
+        in parallel processes; the current model is left unchanged.
         """
-        bics, optimal_n_comp, lowest_bic = \
-            self.XDGMM.bic_test(X, Xerr, component_range, no_err)
+        if np.ndim(Xerr) == 2: Xerr = _expand_diag(Xerr)
+        bics = Parallel(n_jobs=n_jobs)(
+            delayed(_fit_and_bic)(self.XDGMM, n, X, Xerr, no_err)
+            for n in component_range)
+        bics = np.array(bics)
+        best = np.argmin(bics)
+        optimal_n_comp = np.asarray(component_range)[best]
+        lowest_bic = bics[best]
         return bics, optimal_n_comp, lowest_bic
 
     def get_logR(self,cond_indices, R_index, X, Xerr=None):
@@ -196,10 +385,11 @@ class Empiricist(object):
         R_index: int
             Index of log(R/Re) in the list of parameters that were used
             to fit the model.
-        X: array_like, shape = (n < n_features,)
-            Input data.
+        X: array_like, shape = (len(cond_indices),)
+            Input data. X[j] is the value of parameter cond_indices[j].
         Xerr: array_like, shape = (X.shape,) (optional)
-            Error on input data. If none, no error used to condition.
+            Error on input data, in the same order as X. If none, no
+            error used to condition.
 
         Returns
         -------
@@ -222,35 +412,26 @@ class Empiricist(object):
         that were used to fit the model are the SN parameters.
         """
         if self.model_file is None:
-            raise StandardError("Model parameters not set.")
+            raise RuntimeError("Model parameters not set.")
 
         if 0 in cond_indices or 1 in cond_indices or 2 in cond_indices:
             raise ValueError("Cannot condition model on SN parameters.")
         if R_index in cond_indices:
             raise ValueError("Cannot condition model on log(R/Re).")
 
-        cond_data = np.array([])
-        if Xerr is not None: cond_err = np.array([])
-        R_cond_idx = R_index
+        cond_indices = np.asarray(cond_indices)
         n_features = self.XDGMM.mu.shape[1]
-        j = 0
-
-        for i in range(n_features):
-            if i in cond_indices:
-                cond_data = np.append(cond_data,X[j])
-                if Xerr is not None: cond_err = np.append(cond_err, Xerr[j])
-                j += 1
-                if i < R_index: R_cond_idx -= 1
-            else:
-                cond_data = np.append(cond_data,np.nan)
-                if Xerr is not None: cond_err = np.append(cond_err, 0.0)
-
+        cond_data = np.full(n_features, np.nan)
+        cond_data[cond_indices] = X
+        cond_err = None
         if Xerr is not None:
-            cond_XDGMM = self.XDGMM.condition(cond_data, cond_err)
-        else: cond_XDGMM = self.XDGMM.condition(cond_data)
+            cond_err = np.zeros(n_features)
+            cond_err[cond_indices] = Xerr
+        R_cond_idx = R_index - int(np.sum(cond_indices < R_index))
 
-        sample = cond_XDGMM.sample()
-        logR = sample[0][R_cond_idx]
+        weights, means, chols = self._condition(cond_data, cond_err)
+        sample = self._sample_conditioned(weights, means, chols, 1)
+        logR = sample[0, 0, R_cond_idx]
         return logR
 
     def get_local_SB(self, SB_params, R ):
@@ -288,47 +469,10 @@ class Empiricist(object):
 
         sep = (10**R) * SB_params[11] # separation in arcsec
 
-        SBs = np.array([])
-        SB_errs = np.array([])
-
-        for j in range(5):
-            halfmag = SB_params[j*4+1] + 0.75257
-            magerr = SB_params[j*4+2]
-            Re = SB_params[j*4+3]
-            Re_err = SB_params[j*4+4]
-            r = sep/Re
-
-            Ie = halfmag + 2.5 * np.log10(np.pi*Re**2)
-            Re2_unc = 2 * Re * Re_err * np.pi
-            log_unc = 2.5 * Re2_unc/(np.log10(np.pi*Re**2) * np.log(10))
-            Ie_unc = np.sqrt(magerr**2 + log_unc**2)
-
-            if SB_params[0] == 1:
-                Io = Ie-1.824
-                Io_unc = Ie_unc
-                sb = Io*np.exp(-1.68*(r))
-                exp_unc = np.exp(-1.68*(r))*1.68*sep*Re_err/(Re**2)
-                sb_unc = sb * np.sqrt((Io_unc/Io)**2 +
-                                      (exp_unc/np.exp(-1.68*(r)))**2)
-                if np.isnan(sb_unc): sb_unc = 0.0
-                if sb_unc < 0: sb_unc = sb_unc*-1.0
-                SBs = np.append(SBs,sb)
-                SB_errs = np.append(SB_errs,sb_unc)
-
-            if SB_params[0] == 4:
-                Io = Ie-8.328
-                Io_unc = Ie_unc
-                sb = Io*np.exp(-7.67*((r)**0.25))
-                exp_unc = np.exp(-7.67*((r)**0.25))*7.67*sep \
-                          *Re_err/(4*Re**(1.25))
-                sb_unc = sb*np.sqrt((Io_unc/Io)**2+(exp_unc \
-                       /np.exp(-7.67*((r)**0.25))))
-                if np.isnan(sb_unc): sb_unc = 0.0
-                if sb_unc < 0: sb_unc = sb_unc*-1.0
-                SBs = np.append(SBs,sb)
-                SB_errs = np.append(SB_errs,sb_unc)
-
-        return SBs, SB_errs
+        params = np.asarray(SB_params[1:], dtype=float).reshape(5, 4)
+        params = np.ascontiguousarray(params.T)
+        return _sersic_sb(int(SB_params[0]), params[0], params[1],
+                          params[2], params[3], float(sep))
 
     def set_fit_method(self, fit_method):
         """
@@ -373,13 +517,17 @@ class Empiricist(object):
             Output data. Contains SALT2 SN parameters, host redshift,
             log(R/Re), host colors, and host brightnesses at the
             locations of the SN in each filter.
-        Xerr: array_like, shape = (n_samples, n_features, n_features)
-            Error on output data.
+        Xerr: array_like, shape = (n_samples, n_features)
+            Variances of the output data. The errors are uncorrelated,
+            so only the diagonals of the error matrices are returned:
+            use Xerr[:, j] where Xerr[:, j, j] was used before, or
+            _expand_diag(Xerr) to get the full matrices.
 
         Notes
         -----
-        Reads in each data file and returns an array of data and a
-        matrix of errors, which can be used to fit the XDGMM model.
+        Reads in each data file and returns an array of data and an
+        array of error variances, which can be used to fit the XDGMM
+        model.
 
         Currently reads the SALT2 SN parameters, host redshift,
         log(R/Re), host magnitudes, and host surface brightnesses
@@ -388,113 +536,194 @@ class Empiricist(object):
         This method needs further modularizing, to enable the worker
         to calculate host surface brightnesses separately (in a static method).
         """
-        x0 = np.array([])
-        x0_err = np.array([])
-        x1 = np.array([])
-        x1_err = np.array([])
-        c = np.array([])
-        c_err = np.array([])
-        z = np.array([])
-        z_err = np.array([])
-        logr = np.array([])
-        logr_err = np.array([])
-        umag = np.array([])
-        umag_err = np.array([])
-        gmag = np.array([])
-        gmag_err = np.array([])
-        rmag = np.array([])
-        rmag_err = np.array([])
-        imag = np.array([])
-        imag_err = np.array([])
-        zmag = np.array([])
-        zmag_err = np.array([])
-        SB_u = np.array([])
-        SB_u_err = np.array([])
-        SB_g = np.array([])
-        SB_g_err = np.array([])
-        SB_r = np.array([])
-        SB_r_err = np.array([])
-        SB_i = np.array([])
-        SB_i_err = np.array([])
-        SB_z = np.array([])
-        SB_z_err = np.array([])
-
-        for filename in filelist:
-            infile = open(filename,'r')
-            inlines = infile.readlines()
-            infile.close()
-
-            for line1 in inlines:
-                if line1[0]=='#': continue
-                line = line1.split(',')
-                if line[33]=='nan' or line[39]=='nan' or line[45]=='nan'\
-                    or line[51]=='nan' or line[57]=='nan': continue
-
-                # SN params
-                x0 = np.append(x0,float(line[7])) #x0
-                x0_err = np.append(x0_err,float(line[8]))
-                x1 = np.append(x1,float(line[9]))  # x1
-                x1_err = np.append(x1_err,float(line[10]))
-                c = np.append(c,float(line[11]))  # c
-                c_err = np.append(c_err,float(line[12]))
-
-                # Host params
-                z = np.append(z,float(line[4]))
-                z_err = np.append(z_err,0.0)
-                logr = np.append(logr,np.log10(float(line[15])/float(line[42]))) # r
-                logr_err = np.append(logr_err,float(line[43])/(float(line[42])*np.log(10)))
-                umag = np.append(umag,float(line[18]))  # u_mag
-                umag_err = np.append(umag_err,float(line[19]))
-                gmag = np.append(gmag,float(line[20]))  # g_mag
-                gmag_err = np.append(gmag_err,float(line[21]))
-                rmag = np.append(rmag,float(line[22]))  # r_mag
-                rmag_err = np.append(rmag_err,float(line[23]))
-                imag = np.append(imag,float(line[24]))  # i_mag
-                imag_err = np.append(imag_err,float(line[25]))
-                zmag = np.append(zmag,float(line[26]))  # z_mag
-                zmag_err = np.append(zmag_err,float(line[27]))
-                SB_u = np.append(SB_u,float(line[32]))  # SB_u
-                SB_u_err = np.append(SB_u_err,float(line[33]))
-                SB_g = np.append(SB_g,float(line[38]))  # SB_g
-                SB_g_err = np.append(SB_g_err,float(line[39]))
-                SB_r = np.append(SB_r,float(line[44]))  # SB_r
-                SB_r_err = np.append(SB_r_err,float(line[45]))
-                SB_i = np.append(SB_i,float(line[50]))  # SB_i
-                SB_i_err = np.append(SB_i_err,float(line[52]))
-                SB_z = np.append(SB_z,float(line[56]))  # SB_z
-                SB_z_err = np.append(SB_z_err,float(line[57]))
-
-        ug = umag-gmag
-        ug_err = np.sqrt(umag_err**2+gmag_err**2)
-        ur = umag-rmag
-        ur_err = np.sqrt(umag_err**2+rmag_err**2)
-        ui = umag-imag
-        ui_err = np.sqrt(umag_err**2+imag_err**2)
-        uz = umag-zmag
-        uz_err = np.sqrt(umag_err**2+zmag_err**2)
-        gr = gmag-rmag
-        gr_err = np.sqrt(gmag_err**2+rmag_err**2)
-        gi = gmag-imag
-        gi_err = np.sqrt(gmag_err**2+imag_err**2)
-        gz = gmag-zmag
-        gz_err = np.sqrt(gmag_err**2+zmag_err**2)
-        ri = rmag-imag
-        ri_err = np.sqrt(rmag_err**2+imag_err**2)
-        rz = rmag-zmag
-        rz_err = np.sqrt(rmag_err**2+zmag_err**2)
-        iz = imag-zmag
-        iz_err = np.sqrt(imag_err**2+zmag_err**2)
-
-        X = np.vstack([x0,x1,c,z,logr,ug,ur,ui,uz,gr,gi,gz,ri,rz,iz,SB_u,
-                     SB_g,SB_r,SB_i,SB_z]).T
-        Xerr = np.zeros(X.shape + X.shape[-1:])
-        diag = np.arange(X.shape[-1])
-        Xerr[:, diag, diag] = np.vstack([x0_err**2,x1_err**2,c_err**2,
-                                         z_err**2,logr_err**2,ug_err**2,
-                                         ur_err**2,ui_err**2,uz_err**2,
-                                         gr_err**2,gi_err**2,gz_err**2,
-                                         ri_err**2,rz_err**2,iz_err**2,
-                                         SB_u_err**2,SB_g_err**2,
-                                         SB_r_err**2,SB_i_err**2,
-                                         SB_z_err**2]).T
+        # pandas parses in C and releases the GIL, so the files can be
+        # read concurrently.
+        with ThreadPoolExecutor() as executor:
+            arrays = list(executor.map(_read_one_file, filelist))
+        data = np.concatenate([np.empty((0, len(_DATA_COLS)))] + arrays)
+
+        # SN params
+        x0, x0_err = data[:, 0], data[:, 1]
+        x1, x1_err = data[:, 2], data[:, 3]
+        c, c_err = data[:, 4], data[:, 5]
+
+        # Host params
+        z = data[:, 6]
+        z_var = np.zeros(len(data))
+        logr = np.log10(data[:, 7]/data[:, 8])
+        logr_var = (data[:, 9]/(data[:, 8]*np.log(10)))**2
+        mags, mag_errs = data[:, 10:20:2], data[:, 11:20:2] # ugriz
+        SB_u, SB_u_err = data[:, 20], data[:, 21]
+        SB_g, SB_g_err = data[:, 22], data[:, 23]
+        SB_r, SB_r_err = data[:, 24], data[:, 25]
+        SB_i, SB_i_err = data[:, 26], data[:, 27]
+        SB_z, SB_z_err = data[:, 28], data[:, 29]
+
+        colors = np.dot(mags, _COLOR_MATRIX.T)
+        color_vars = np.dot(mag_errs**2, _COLOR_MATRIX.T**2)
+
+        X = np.column_stack([x0,x1,c,z,logr,colors,SB_u,SB_g,SB_r,SB_i,
+                             SB_z])
+        Xerr = np.column_stack([x0_err**2,x1_err**2,c_err**2,z_var,
+                                logr_var,color_vars,SB_u_err**2,
+                                SB_g_err**2,SB_r_err**2,SB_i_err**2,
+                                SB_z_err**2])
         return X, Xerr
+
+    def _condition(self, X, Xerr=None):
+        """
+        Conditions the model on each row of X at once.
+
+        Parameters
+        ----------
+        X: array_like, shape = (n_hosts, n_features)
+            Input data. Parameters to be sampled should be NaN, and
+            must be the same for every row.
+        Xerr: array_like, shape = (n_hosts, n_features), optional
+            Error on input data, added to the diagonal of the model
+            covariances for the parameters that are set.
+
+        Returns
+        -------
+        weights: array_like, shape = (n_hosts, n_components)
+            Weights of the conditioned components.
+        means: array_like, shape = (n_hosts, n_components, n_hidden)
+            Means of the conditioned components.
+        chols: array_like, shape = ([n_hosts,] n_components, n_hidden,
+                                    n_hidden)
+            Cholesky factors of the conditioned covariances. These only
+            depend on the host if Xerr is given.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        hidden = np.isnan(X[0])
+        if (np.isnan(X) != hidden).any():
+            raise ValueError("All rows of X must have the same NaN entries.")
+        obs = ~hidden
+        if Xerr is not None:
+            Xerr = np.atleast_2d(np.asarray(Xerr, dtype=float))
+
+        L_inv, gain, chols, logdet = self._cond_operators(hidden, Xerr)
+
+        # Whiten the offsets from the component means with the inverse
+        # Cholesky factors of the covariances of the set parameters.
+        mu = np.asarray(self.XDGMM.mu)
+        diff = X[:, None, obs] - mu[:, obs]
+        white = np.matmul(L_inv, diff[..., None])[..., 0]
+        means = mu[:, hidden] + np.matmul(gain, white[..., None])[..., 0]
+        maha = np.sum(white**2, axis=-1)
+
+        logp = np.log(self.XDGMM.weights) - 0.5*(maha + logdet)
+        logp -= logp.max(axis=1)[:, None]
+        weights = np.exp(logp)
+        weights /= weights.sum(axis=1)[:, None]
+        return weights, means, chols
+
+    def _precompute_sn_conditioning(self):
+        """
+        Caches the conditioning operators used by get_SN, where only the
+        SN parameters (the first three) are missing, so that the first
+        call does not pay for them.
+        """
+        hidden = np.zeros(np.shape(self.XDGMM.mu)[1], dtype=bool)
+        hidden[:3] = True
+        self._cond_operators(hidden)
+
+    def _cond_operators(self, hidden, Xerr=None):
+        """
+        Computes the parts of the conditioned model that depend only on
+        which parameters are set, not on their values.
+
+        Parameters
+        ----------
+        hidden: array_like, shape = (n_features,)
+            Boolean mask of the parameters that are not set.
+        Xerr: array_like, shape = (n_hosts, n_features), optional
+            Error on the input data, added to the diagonal of the model
+            covariances for the parameters that are set.
+
+        Returns
+        -------
+        L_inv: array_like, shape = ([n_hosts,] n_components, n_obs,
+                                    n_obs)
+            Inverses of the lower Cholesky factors of the covariances
+            of the set parameters.
+        gain: array_like, shape = ([n_hosts,] n_components, n_hidden,
+                                   n_obs)
+            Matrices mapping whitened offsets of the set parameters
+            from the component means onto the conditioned means.
+        chols: array_like, shape = ([n_hosts,] n_components, n_hidden,
+                                    n_hidden)
+            Cholesky factors of the conditioned covariances.
+        logdet: array_like, shape = ([n_hosts,] n_components)
+            Log-determinants of the covariances of the set parameters.
+
+        Notes
+        -----
+        Without errors the result is cached for each `hidden` mask, so
+        repeated conditioning on the same parameters only costs a few
+        matrix-vector products. The cache is reset whenever the model
+        changes.
+        """
+        key = tuple(np.flatnonzero(hidden).tolist())
+        if Xerr is None and key in self._cond_cache:
+            return self._cond_cache[key]
+
+        obs = ~hidden
+        V = np.asarray(self.XDGMM.V)
+        V_hh = V[:, hidden][:, :, hidden]
+        V_ho = V[:, hidden][:, :, obs]
+        V_oo = V[:, obs][:, :, obs]
+        if Xerr is not None:
+            n_obs = V_oo.shape[-1]
+            V_oo = V_oo + (Xerr[:, None, obs, None] * np.eye(n_obs))
+
+        # Only the triangular factor L of V_oo is inverted, by
+        # triangular solves; V_oo^-1 itself is never formed. With
+        # V_ho V_oo^-1 V_oh = (L^-1 V_oh)^T (L^-1 V_oh), conditioning
+        # then only needs products with L^-1.
+        L_oo = np.linalg.cholesky(V_oo)
+        L_inv = np.empty(L_oo.shape)
+        eye = np.eye(L_oo.shape[-1])
+        for idx in np.ndindex(L_oo.shape[:-2]):
+            L_inv[idx] = solve_triangular(L_oo[idx], eye, lower=True)
+        white_oh = np.matmul(L_inv, np.swapaxes(V_ho, -1, -2))
+        gain = np.swapaxes(white_oh, -1, -2)
+        chols = np.linalg.cholesky(V_hh - np.matmul(gain, white_oh))
+        logdet = 2*np.sum(np.log(np.diagonal(L_oo, axis1=-2, axis2=-1)),
+                          axis=-1)
+
+        operators = (L_inv, gain, chols, logdet)
+        if Xerr is None: self._cond_cache[key] = operators
+        return operators
+
+    def _sample_conditioned(self, weights, means, chols, size):
+        """
+        Draws samples from a set of conditioned mixtures.
+
+        Parameters
+        ----------
+        weights, means, chols: array_like
+            Conditioned mixtures, as returned by _condition.
+        size: int
+            Number of samples to draw from each mixture.
+
+        Returns
+        -------
+        samples: array_like, shape = (n_hosts, size, n_hidden)
+            Samples drawn from each mixture.
+        """
+        n_hosts, n_comp, n_hidden = means.shape
+        rows = np.arange(n_hosts)[:, None]
+
+        # Pick components by inverting the cumulative weights, which
+        # np.random.choice cannot do for a different set of weights per
+        # host.
+        u = self._rng.random((n_hosts, size))
+        cum_weights = np.cumsum(weights, axis=1)
+        comp = np.sum(u[..., None] > cum_weights[:, None, :], axis=-1)
+        comp = np.minimum(comp, n_comp-1)
+
+        if chols.ndim == 3: L = chols[comp]
+        else: L = chols[rows, comp]
+        z = self._rng.standard_normal((n_hosts, size, n_hidden))
+        return means[rows, comp] + np.einsum('nsij,nsj->nsi', L, z)
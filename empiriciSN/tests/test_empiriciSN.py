@@ -4,61 +4,185 @@ Test code for empiriciSN class.
 import unittest
 import numpy as np
 import empiriciSN
-import urllib
 import os
 
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..')
+model_path = os.path.join(root, 'models', 'empiriciSN_model.fit')
+snls_path = os.path.join(root, 'Notebooks', 'data_files', 'snls_master.csv')
+
+def read_data_lines(filename):
+    """
+    Parses a data file line by line, as get_data originally did, and
+    returns the data and error variances.
+    """
+    X = []
+    Xerr = []
+    for line1 in open(filename).readlines():
+        if line1[0]=='#': continue
+        line = line1.split(',')
+        if line[33]=='nan' or line[39]=='nan' or line[45]=='nan'\
+            or line[51]=='nan' or line[57]=='nan': continue
+        val = lambda i: float(line[i])
+        mags = np.array([val(18),val(20),val(22),val(24),val(26)])
+        mag_errs = np.array([val(19),val(21),val(23),val(25),val(27)])
+        colors = []
+        color_errs = []
+        for a in range(5):
+            for b in range(a+1,5):
+                colors.append(mags[a]-mags[b])
+                color_errs.append(np.sqrt(mag_errs[a]**2+mag_errs[b]**2))
+        X.append([val(7),val(9),val(11),val(4),np.log10(val(15)/val(42))]
+                 + colors + [val(32),val(38),val(44),val(50),val(56)])
+        errs = [val(8),val(10),val(12),0.0,val(43)/(val(42)*np.log(10))] \
+               + color_errs + [val(33),val(39),val(45),val(52),val(57)]
+        Xerr.append(np.array(errs)**2)
+    return np.array(X), np.array(Xerr)
+
+def local_SB_loop(SB_params, R):
+    """
+    Computes local surface brightnesses one filter at a time, as
+    get_local_SB originally did.
+    """
+    sep = (10**R) * SB_params[11]
+    SBs = []
+    SB_errs = []
+    for j in range(5):
+        halfmag = SB_params[j*4+1] + 0.75257
+        magerr = SB_params[j*4+2]
+        Re = SB_params[j*4+3]
+        Re_err = SB_params[j*4+4]
+        r = sep/Re
+
+        Ie = halfmag + 2.5 * np.log10(np.pi*Re**2)
+        Re2_unc = 2 * Re * Re_err * np.pi
+        log_unc = 2.5 * Re2_unc/(np.log10(np.pi*Re**2) * np.log(10))
+        Ie_unc = np.sqrt(magerr**2 + log_unc**2)
+
+        if SB_params[0] == 1:
+            Io = Ie-1.824
+            sb = Io*np.exp(-1.68*(r))
+            exp_unc = np.exp(-1.68*(r))*1.68*sep*Re_err/(Re**2)
+            sb_unc = sb * np.sqrt((Ie_unc/Io)**2 +
+                                  (exp_unc/np.exp(-1.68*(r)))**2)
+        else:
+            Io = Ie-8.328
+            sb = Io*np.exp(-7.67*((r)**0.25))
+            exp_unc = np.exp(-7.67*((r)**0.25))*7.67*sep \
+                      *Re_err/(4*Re**(1.25))
+            sb_unc = sb*np.sqrt((Ie_unc/Io)**2+(exp_unc \
+                   /np.exp(-7.67*((r)**0.25))))
+        if np.isnan(sb_unc): sb_unc = 0.0
+        SBs.append(sb)
+        SB_errs.append(abs(sb_unc))
+    return np.array(SBs), np.array(SB_errs)
+
 class EmpiricistTestCase(unittest.TestCase):
     "TestCase class for Empiricist class."
     def setUp(self):
         """
         Set up each test with a new empiriciSN object with existing model.
         """
-        url = 'https://raw.githubusercontent.com/tholoien/empiriciSN/' \
-            + 'master/models/empiriciSN_model.fit'
-        path = './empiriciSN_model.fit'
-        urllib.urlretrieve(url, path)
-        self.empiricist = empiriciSN.Empiricist(model_file = 'empiriciSN_model.fit')
+        self.empiricist = empiriciSN.Empiricist(model_file = model_path)
         self.files = []
 
     def tearDown(self):
         """
         Clean up files saved by tests
         """
-        os.remove('empiriciSN_model.fit')
-        if os.path.isfile('snls_master.csv'):
-            os.remove('snls_master.csv')
         if os.path.isfile('empiriciSN_model.fit'):
             os.remove('empiriciSN_model.fit')
 
     def test_get_SN(self):
-        url = 'https://raw.githubusercontent.com/tholoien/empiriciSN/' \
-            +'master/models/empiriciSN_model.fit'
-        path = './empiriciSN_model.fit'
-        urllib.urlretrieve(url, path)
-        self.empiricist.read_model('empiriciSN_model.fit')
+        self.empiricist.read_model(model_path)
         sample = self.empiricist.XDGMM.sample()[0]
         testdat = np.append(np.array([np.nan,np.nan,np.nan]),sample[3:])
         sn = self.empiricist.get_SN(testdat)
         self.assertEqual(sn.shape,(1,3))
 
-    def test_fit(self):
-        url = 'https://raw.githubusercontent.com/tholoien/empiriciSN/' \
-            +'master/Notebooks/data_files/snls_master.csv'
-        path = './snls_master.csv'
-        urllib.urlretrieve(url, path)
+    def test_no_model(self):
+        empiricist = empiriciSN.Empiricist()
+        x = np.append(np.array([np.nan,np.nan,np.nan]),np.zeros(17))
+        self.assertRaises(RuntimeError, empiricist.get_SN, x)
+        self.assertRaises(RuntimeError, empiricist.get_logR,
+                          np.array([3,5]), 4, np.zeros(2))
+
+    def test_condition(self):
+        # A point between two components of the bundled model, so that
+        # both carry weight after conditioning. Random samples can land
+        # where the nearly singular covariances make the reference pdf
+        # unreliable.
+        mu = self.empiricist.XDGMM.mu
+        point = 0.7*mu[1] + 0.3*mu[2]
+        x = np.append(np.array([np.nan,np.nan,np.nan]),point[3:])
+        xerr = np.append(np.zeros(3),np.full(len(x)-3,1e-4))
+
+        for err in [None, xerr]:
+            if err is None:
+                cond_XDGMM = self.empiricist.XDGMM.condition(x)
+                weights, means, chols = self.empiricist._condition(x)
+            else:
+                cond_XDGMM = self.empiricist.XDGMM.condition(x, err)
+                weights, means, chols = self.empiricist._condition(x, err)
+                chols = chols[0]
+            V = np.matmul(chols, np.swapaxes(chols, -1, -2))
 
-        this_model_file = self.empiricist.model_file
+            self.assertTrue(np.allclose(weights[0], cond_XDGMM.weights))
+            self.assertTrue(np.allclose(means[0], cond_XDGMM.mu))
+            self.assertTrue(np.allclose(V, cond_XDGMM.V))
 
-        self.empiricist.fit_from_files(['snls_master.csv'],n_components=1)
+    def test_get_SN_batch(self):
+        samples = self.empiricist.XDGMM.sample(4)
+        X = np.copy(samples)
+        X[:,:3] = np.nan
+        sn = self.empiricist.get_SN(X, n_SN=5)
+        self.assertEqual(sn.shape,(4,5,3))
+
+        X[1,3] = np.nan
+        self.assertRaises(ValueError, self.empiricist.get_SN, X)
+
+    def test_fit(self):
+        this_model_file = 'empiriciSN_model.fit'
+
+        self.empiricist.fit_from_files([snls_path],filename=this_model_file,
+                                       n_components=1)
 
         self.assertEqual(self.empiricist.model_file,this_model_file)
 
+    def test_get_data(self):
+        X, Xerr = self.empiricist.get_data([snls_path])
+        X_lines, Xerr_lines = read_data_lines(snls_path)
+        self.assertEqual(Xerr.shape, X.shape)
+        self.assertTrue(np.all(Xerr >= 0))
+        self.assertTrue(np.allclose(X, X_lines))
+        self.assertTrue(np.allclose(Xerr, Xerr_lines))
+        self.assertTrue(np.allclose(empiriciSN.empiriciSN._expand_diag(Xerr)
+                                    [:, 5, 5], Xerr[:, 5]))
+
+        X_empty, Xerr_empty = self.empiricist.get_data([])
+        self.assertEqual(X_empty.shape, (0, 20))
+        self.assertEqual(Xerr_empty.shape, (0, 20))
+
+        self.empiricist.fit_model(X, Xerr, n_components=1)
+        self.assertEqual(self.empiricist.XDGMM.n_components, 1)
+
+    def test_component_test(self):
+        X, Xerr = self.empiricist.get_data([snls_path])
+        n_components = self.empiricist.XDGMM.n_components
+
+        # n_jobs=2 runs the fits in joblib worker processes
+        for n_jobs in [1, 2]:
+            bics, optimal_n_comp, lowest_bic = \
+                self.empiricist.component_test(X[:50], Xerr[:50], [1, 2],
+                                               n_jobs=n_jobs)
+
+            self.assertEqual(len(bics), 2)
+            self.assertIn(optimal_n_comp, [1, 2])
+            self.assertEqual(lowest_bic, np.min(bics))
+            self.assertEqual(self.empiricist.XDGMM.n_components,
+                             n_components)
+
     def test_get_logR(self):
-        url = 'https://raw.githubusercontent.com/tholoien/empiriciSN/' \
-            +'master/models/empiriciSN_model.fit'
-        path = './empiriciSN_model.fit'
-        urllib.urlretrieve(url, path)
-        self.empiricist.read_model('empiriciSN_model.fit')
+        self.empiricist.read_model(model_path)
         sample = self.empiricist.XDGMM.sample()[0]
 
         indeces = np.array([3,5,6,7,8,9,10,11,12,13,14])
@@ -80,5 +204,25 @@ class EmpiricistTestCase(unittest.TestCase):
         
         self.assertNotEqual(0,len(SB))
 
+        # Compare with the per-filter formula, including a zero radius
+        # and a separation at which the profile underflows to zero.
+        re_zero = np.copy(sb_params)
+        re_zero[7] = 0.0
+        with np.errstate(all='ignore'):
+            for sersic in [1, 4]:
+                for params, R in [(sb_params, logR), (sb_params, 2.8),
+                                  (re_zero, logR)]:
+                    params = np.copy(params)
+                    params[0] = sersic
+                    expected = local_SB_loop(params, R)
+                    result = self.empiricist.get_local_SB(params, R)
+                    sep = (10**R) * params[11]
+                    vectorized = empiriciSN.empiriciSN._sersic_sb_numpy(
+                        sersic, *np.reshape(params[1:], (5, 4)).T, sep=sep)
+                    for res in [result, vectorized]:
+                        for a, b in zip(res, expected):
+                            self.assertTrue(np.allclose(a, b,
+                                                        equal_nan=True))
+
 if __name__ == '__main__':
     unittest.main()
@@ -21,5 +21,5 @@ setup(
         "Operating System :: OS Independent",
         "Programming Language :: Python",
     ],
-    install_requires=["numpy", "xdgmm", "scipy"],
+    install_requires=["numpy", "xdgmm", "scipy", "pandas", "joblib"],
 )